@@ -2,101 +2,196 @@
 
 import argparse
 import csv
-import dataclasses
 import datetime as dt
+import httpx
+import itertools
 import lzma
 import os
-import requests
-import sqlitedict
-import threading
+import pickle
+import queue
+import sqlite3
+import sys
 import time as timelib
 
-from concurrent.futures import ThreadPoolExecutor
-
-
-@dataclasses.dataclass
-class InventoryStation:
-    name: str
-    province: str
-    climateId: str
-    stationId: int
-    wmoId: int
-    tcId: str
-    latitudeDecimalDegrees: float
-    longitudeDecimalDegrees: float
-    latitude: int
-    longitude: int
-    elevation: float
-    firstYear: int
-    lastYear: int
-    hlyFirstYear: int
-    hlyLastYear: int
-    dlyFirstYear: int
-    dlyLastYear: int
-    mlyFirstYear: int
-    mlyLastYear: int
-
-    def dailyYearsIter(self):
-        if self.dlyFirstYear is not None:
-            yield from range(self.dlyFirstYear, self.dlyLastYear+1)
-
-pool = ThreadPoolExecutor(max_workers=8)
-futures = []
-
-class LocalSession(threading.local):
-    def __init__(self):
-        super().__init__()
-        self.session = requests.Session()
-
-threadLocal = LocalSession()
-stationRefresh = sqlitedict.SqliteDict('StationRefresh.db', autocommit=True)
-
-def getOneFile(url, dirname, localPath):
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+dailyUrlFormat = (
+    'https://climate.weather.gc.ca/climate_data/bulk_data_e.html'
+    '?format=csv&stationID=%d&Year=%d&Month=1&Day=1&timeframe=2' )
+
+retryStatuses = {429, 500, 502, 503, 504}
+retryCount = 3
+
+def openClient(workers):
+    # Every download goes to the same host, so one client shared by all
+    # workers keeps connections alive. Over HTTP/2 the workers' requests
+    # share a single multiplexed connection; the limit only matters if the
+    # server falls back to HTTP/1.1 and needs one connection per worker.
+    limits = httpx.Limits(max_connections=workers,
+                          max_keepalive_connections=workers)
+    # No transport-level retries: getOneFile retries every transport error
+    # itself, and doing both would multiply the connect attempts.
+    transport = httpx.HTTPTransport(http2=True, limits=limits)
+    return httpx.Client(transport=transport, timeout=10,
+                        follow_redirects=True)
+
+stationRefresh = sqlite3.connect('StationRefresh.db')
+for pragma in ( 'journal_mode=WAL', 'synchronous=NORMAL', 'busy_timeout=5000',
+                'temp_store=MEMORY', 'cache_size=-64000' ):
+    stationRefresh.execute(f'PRAGMA {pragma}')
+stationRefresh.execute(
+    'CREATE TABLE IF NOT EXISTS refresh('
+    'path TEXT PRIMARY KEY, refreshTime REAL, etag TEXT, lastModified TEXT) '
+    'WITHOUT ROWID')
+
+def migrateValidatorColumns():
+    # Tables created before conditional requests only had the timestamp.
+    columns = { row[1] for row
+                in stationRefresh.execute('PRAGMA table_info(refresh)') }
+    for column in ('etag', 'lastModified'):
+        if column not in columns:
+            stationRefresh.execute(
+                f'ALTER TABLE refresh ADD COLUMN {column} TEXT')
+    stationRefresh.commit()
+
+def migrateSqliteDict():
+    # Older versions kept the timestamps pickled in sqlitedict's default
+    # table; carry them over once so nothing gets redownloaded.
+    table = stationRefresh.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='unnamed'")
+    if table.fetchone() is None:
+        return
+    rows = [ (key, pickle.loads(value)) for key, value
+             in stationRefresh.execute('SELECT key, value FROM unnamed') ]
+    stationRefresh.executemany(
+        'INSERT OR IGNORE INTO refresh(path, refreshTime) VALUES (?, ?)',
+        rows)
+    stationRefresh.execute('DROP TABLE unnamed')
+    stationRefresh.commit()
+
+migrateValidatorColumns()
+migrateSqliteDict()
+
+# Workers report finished files here; the main thread writes them to
+# stationRefresh in batches so each file doesn't cost its own transaction.
+refreshQueue = queue.Queue()
+refreshBatchSize = 100
+# Presets 0-3 use lzma's fast match finder; on a single year of daily CSV
+# the ratio is close to the default 6 for a fraction of the CPU and memory.
+lzmaPreset = 3
+
+def getOneFile(client, url, localPath, etag, lastModified):
     print(url)
-    os.makedirs(dirname, exist_ok=True)
-    response = threadLocal.session.get(url, timeout=10)
-    f = lzma.open(localPath, 'wb')
-    f.write(response.content)
-    f.close()
-    stationRefresh[localPath] = timelib.time()
+    headers = {}
+    if os.path.exists(localPath):
+        # Let the server answer 304 instead of resending an unchanged year.
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        if lastModified is not None:
+            headers['If-Modified-Since'] = lastModified
+    # Back off and retry failed connects, dropped reads, and busy or
+    # failing responses.
+    for attempt in range(retryCount+1):
+        try:
+            response = client.get(url, headers=headers)
+        except httpx.TransportError:
+            if attempt == retryCount:
+                raise
+        else:
+            if ( response.status_code not in retryStatuses
+                 or attempt == retryCount ):
+                break
+        timelib.sleep(0.5 * 2**attempt)
+    if response.status_code == 304:
+        refreshQueue.put((localPath, timelib.time(), etag, lastModified))
+        return None
+    if response.status_code == 404:
+        # The station has no data for this year; leave it unrecorded so
+        # it's asked for again next run.
+        print(f'{url}: not found, skipping', file=sys.stderr)
+        return None
+    # Never store an error page (or anything else but the data) as a year.
+    # 5xx only gets here once its retries are used up; the caller logs it
+    # and carries on with the other station-years.
+    response.raise_for_status()
+    if response.status_code != 200:
+        raise httpx.HTTPStatusError(
+            f'Unexpected status {response.status_code} for {url}',
+            request=response.request, response=response)
+    # Compression is handed back to the main thread for the compress pool,
+    # so this worker can move straight on to its next download.
+    return ( localPath, response.content,
+             response.headers.get('ETag'),
+             response.headers.get('Last-Modified') )
+
+def writeOneFile(localPath, content, etag, lastModified):
+    # lzma releases the GIL while compressing, so a thread per core is
+    # enough to use every core without pickling bodies into processes.
+    compressed = lzma.compress(content, preset=lzmaPreset)
+    with open(localPath, 'wb') as f:
+        f.write(compressed)
+    refreshQueue.put((localPath, timelib.time(), etag, lastModified))
     # print('done')
 
+def flushRefresh():
+    rows = []
+    while True:
+        try:
+            rows.append(refreshQueue.get_nowait())
+        except queue.Empty:
+            break
+    stationRefresh.executemany(
+        'INSERT OR REPLACE INTO refresh VALUES (?, ?, ?, ?)', rows)
+    stationRefresh.commit()
 
-def calcRefresh(year, lastRefresh):
-    today = dt.date.today()
-    threeDaysAgo = today - dt.timedelta(days=3)
-    if year == today.year or year == threeDaysAgo.year:
-        if timelib.time() - lastRefresh > 3600:
+def reapFinished(pending, compressPool, failures):
+    # Handle downloads in the order they finish, so one slow response
+    # doesn't hold up everything submitted after it. pending maps each
+    # future to the file it is for.
+    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        localPath = pending.pop(future)
+        try:
+            download = future.result()
+        except Exception as e:
+            # One bad station-year shouldn't end a multi-hour refresh.
+            print(f'{localPath}: {e!r}', file=sys.stderr)
+            failures.append(localPath)
+            continue
+        if download is not None:
+            pending[compressPool.submit(writeOneFile, *download)] = localPath
+    if refreshQueue.qsize() >= refreshBatchSize:
+        flushRefresh()
+
+
+def calcRefresh(year, lastRefresh, now, todayYear, threeDaysAgoYear):
+    # The clock-derived arguments are computed once per run by the caller.
+    age = now - lastRefresh
+    if year == todayYear or year == threeDaysAgoYear:
+        if age > 3600:
             # It's the last 3 days, refresh once per hour
             return True
-    elif year == today.year - 1:
-        if timelib.time() - lastRefresh > 3600*24*30:
+    elif year == todayYear - 1:
+        if age > 3600*24*30:
             # It's last year, refresh once per month
             return True
-    elif timelib.time() - lastRefresh > 3600*24*365:
+    elif age > 3600*24*365:
         # Refresh at least once per year
         return True
     return False
 
 def readCsvData(args):
-    csvData = ( open(args.station_inventory)
-                .read()
-                .split('\n') )
-    while not csvData[0].startswith('"Name"'):
-        csvData.pop(0)
-    return csv.reader(csvData)
-
-def getStation(tokens):
-    fields = dataclasses.fields(InventoryStation)
-    for i, field in enumerate(fields):
-        if len(tokens[i]) == 0:
-            tokens[i] = None
-        else:
-            tokens[i] = field.type(tokens[i])
-    station = InventoryStation(*tokens)
-    return station
+    with open(args.station_inventory, newline='') as f:
+        # Skip the free-form preamble above the header row.
+        for line in f:
+            if line.startswith('"Name"'):
+                yield from csv.reader(itertools.chain([line], f))
+                return
+    raise ValueError(f'{args.station_inventory}: no "Name" header row')
 
-def update(args):
+def parseStations(args):
+    stations = []
     for rowIndex, tokens in enumerate(readCsvData(args)):
         if rowIndex == 0:
             expectedHeader = [
@@ -106,25 +201,147 @@ def update(args):
                 "Last Year", "HLY First Year", "HLY Last Year", "DLY First Year",
                 "DLY Last Year", "MLY First Year", "MLY Last Year" ]
             assert tokens == expectedHeader
+            # Only these columns are needed, so don't convert whole rows.
+            stationIdIndex = tokens.index("Station ID")
+            dlyFirstYearIndex = tokens.index("DLY First Year")
+            dlyLastYearIndex = tokens.index("DLY Last Year")
             continue
         if len(tokens) == 0:
             continue
-        station = getStation(tokens)
-        dirname = f'stations/{station.stationId//1000}/{station.stationId}'
-        # print(f'{station.name.title()}: {dirname}: {station.dlyFirstYear}-{station.dlyLastYear}')
-        for year in station.dailyYearsIter():
-            fname = f'{dirname}/{year}.csv.xz'
+        dlyFirstYear = tokens[dlyFirstYearIndex]
+        if len(dlyFirstYear) == 0:
+            continue
+        stations.append( ( int(tokens[stationIdIndex]),
+                           int(dlyFirstYear),
+                           int(tokens[dlyLastYearIndex]) ) )
+    return stations
+
+def readStations(args):
+    # The inventory rarely changes, so reuse the last parse for as long as
+    # the CSV's mtime matches the one it was parsed from.
+    cachePath = args.station_inventory + '.pkl'
+    mtime = os.path.getmtime(args.station_inventory)
+    try:
+        with open(cachePath, 'rb') as f:
+            cachedMtime, stations = pickle.load(f)
+        if cachedMtime == mtime:
+            return stations
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+    stations = parseStations(args)
+    if len(stations) == 0:
+        # Likely a bad download; don't pin it until the CSV changes.
+        return stations
+    # The cache is only a shortcut: write it atomically, and carry on
+    # without it if the inventory's directory isn't writable.
+    try:
+        with open(cachePath + '.tmp', 'wb') as f:
+            pickle.dump((mtime, stations), f)
+        os.replace(cachePath + '.tmp', cachePath)
+    except OSError:
+        pass
+    return stations
+
+def summarizeRefreshes(refreshCache):
+    # Per station directory: the oldest refresh time, the first and last
+    # year on record, and how many years are on record.
+    summary = {}
+    for path, (refreshTime, etag, lastModified) in refreshCache.items():
+        dirname, _, basename = path.rpartition('/')
+        year = int(basename.split('.', 1)[0])
+        oldest, firstYear, lastYear, count = summary.get(
+            dirname, (refreshTime, year, year, 0))
+        summary[dirname] = ( min(oldest, refreshTime), min(firstYear, year),
+                             max(lastYear, year), count + 1 )
+    return summary
+
+def update(args):
+    client = openClient(args.workers)
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+    compressPool = ThreadPoolExecutor(max_workers=os.cpu_count())
+    now = timelib.time()
+    today = dt.date.today()
+    todayYear = today.year
+    threeDaysAgoYear = (today - dt.timedelta(days=3)).year
+    # One cursor pass is far cheaper than a SELECT per station-year.
+    refreshCache = { path: (refreshTime, etag, lastModified)
+                     for path, refreshTime, etag, lastModified
+                     in stationRefresh.execute(
+                         'SELECT path, refreshTime, etag, lastModified '
+                         'FROM refresh') }
+    stationSummary = summarizeRefreshes(refreshCache)
+    # Years before last year are refreshed once a year; see calcRefresh.
+    staleBefore = now - 3600*24*365
+    tasks = []
+    queued = set()
+    for stationId, dlyFirstYear, dlyLastYear in readStations(args):
+        dirname = f'stations/{stationId//1000}/{stationId}'
+        fnameFormat = dirname + '/%d.csv.xz'
+        if args.force is False and dlyLastYear < todayYear - 1:
+            # Every year falls under the yearly rule, so if all of them are
+            # on record and even the oldest is fresh, skip the station.
+            oldest, firstYear, lastYear, count = stationSummary.get(
+                dirname, (0, None, None, 0))
+            if ( oldest >= staleBefore
+                 and firstYear == dlyFirstYear and lastYear == dlyLastYear
+                 and count == dlyLastYear - dlyFirstYear + 1 ):
+                continue
+        # Created on the first download for the station, not once per year.
+        dirnameExists = False
+        for year in range(dlyFirstYear, dlyLastYear+1):
+            fname = fnameFormat % year
+            if fname in queued:
+                # The inventory lists this station more than once.
+                continue
+            etag = lastModified = None
             if args.force is False:
-                lastRefresh = stationRefresh.get(fname, 0)
-                if calcRefresh(year, lastRefresh) is False:
+                lastRefresh, etag, lastModified = refreshCache.get(
+                    fname, (0, None, None))
+                if calcRefresh(year, lastRefresh, now,
+                               todayYear, threeDaysAgoYear) is False:
                     continue
-            url = (
-                f'https://climate.weather.gc.ca/climate_data/bulk_data_e.html'
-                f'?format=csv&stationID={station.stationId}&Year={year}'
-                f'&Month=1&Day=1&timeframe=2' )
-            futures.append(pool.submit(getOneFile, url, dirname, fname))
-    while len(futures):
-        futures.pop(0).result()
+            url = dailyUrlFormat % (stationId, year)
+            if dirnameExists is False:
+                os.makedirs(dirname, exist_ok=True)
+                dirnameExists = True
+            queued.add(fname)
+            tasks.append((year, stationId, url, fname, etag, lastModified))
+    # Newest years first: they change most often, so an interrupted run
+    # still leaves the most useful data fresh.
+    tasks.sort(key=lambda task: (-task[0], task[1]))
+    # Keep enough queued to keep every worker busy without holding a future
+    # (or a downloaded body) for every station-year at once.
+    maxPending = args.workers * 4
+    pending = {}
+    failures = []
+    try:
+        for year, stationId, url, fname, etag, lastModified in tasks:
+            # Reaping a download can just swap it for a compress job, so
+            # keep going until something has actually left the pipeline.
+            while len(pending) >= maxPending:
+                reapFinished(pending, compressPool, failures)
+            future = pool.submit(
+                getOneFile, client, url, fname, etag, lastModified)
+            pending[future] = fname
+        while pending:
+            reapFinished(pending, compressPool, failures)
+    finally:
+        # On an abort, drop the queued work and let what's running finish
+        # before recording it. Every submitted future is in pending, which
+        # is what shutdown(cancel_futures=True) would cancel on 3.9+.
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+        compressPool.shutdown()
+        # Record whatever finished, even if the run was interrupted.
+        flushRefresh()
+    return failures
+
+def positiveInt(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
 
 def main():
     parser = argparse.ArgumentParser(
@@ -133,8 +350,12 @@ def main():
                         help='Redownload all data, regardless of age.')
     parser.add_argument('--station-inventory', default='Station Inventory EN.csv',
                         help='Where to read station data from.')
+    parser.add_argument('--workers', type=positiveInt, default=8,
+                        help='Number of files to download concurrently.')
     args = parser.parse_args()
-    update(args)
+    failures = update(args)
+    if failures:
+        parser.exit(1, f'{len(failures)} station-years failed to download.\n')
 
 
 if __name__=='__main__':